@@ -18,8 +18,9 @@ from bpy.props import (
     FloatVectorProperty, IntVectorProperty
 )
 from bpy.types import (Panel, Operator, PropertyGroup)
-from mathutils import (Vector, Color)
+from mathutils import Color
 import math
+import itertools
 import numpy
 from numpy import random
 
@@ -45,6 +46,61 @@ def make_2d_capacity_from_1d(count):
     assert w*h >= count
     return w, h
 
+
+class GenomeIndex:
+    """Grid hash of flat genomes, used to detect near-duplicate offspring.
+    
+    Cells are as wide as the minimum allowed distance along the first few
+    genes, so a genome can only be too close to genomes stored in the same
+    or an adjacent cell. Each cell stores its genomes in a growing array.
+    A `min_distance` of zero disables detection entirely."""
+    
+    grid_dimensions = 3
+    
+    def __init__(self, min_distance):
+        self.min_distance = min_distance
+        self.cells = {}
+        self.offspring = []
+    
+    def cell_of(self, genome):
+        return tuple(numpy.floor(genome[:self.grid_dimensions] / self.min_distance).astype(int))
+    
+    def has_neighbour(self, genome):
+        """Is there a stored genome closer than `min_distance` to this one?"""
+        if self.min_distance <= 0:
+            return False
+        cell = self.cell_of(genome)
+        for offset in itertools.product((-1, 0, 1), repeat=len(cell)):
+            bucket = self.cells.get(tuple(c + o for c, o in zip(cell, offset)))
+            if bucket is None:
+                continue
+            rows, count = bucket
+            if (numpy.linalg.norm(rows[:count] - genome, axis=1) < self.min_distance).any():
+                return True
+        return False
+    
+    def insert(self, genome, offspring=False):
+        if offspring:
+            self.offspring.append(genome)
+        if self.min_distance <= 0:
+            return
+        # Buckets are [rows, count], rows doubling in size when full
+        bucket = self.cells.setdefault(self.cell_of(genome), [numpy.empty((4, len(genome))), 0])
+        rows, count = bucket
+        if count == len(rows):
+            rows = bucket[0] = numpy.concatenate((rows, numpy.empty_like(rows)))
+        rows[count] = genome
+        bucket[1] = count + 1
+    
+    def offspring_nearest_distances(self):
+        """Distance from each inserted offspring to its nearest sibling offspring."""
+        if len(self.offspring) < 2:
+            return []
+        pts = numpy.array(self.offspring)
+        d = numpy.linalg.norm(pts[:, None, :] - pts[None, :, :], axis=-1)
+        numpy.fill_diagonal(d, numpy.inf)
+        return list(d.min(axis=1))
+
 #
 # Blender-related functions
 #
@@ -64,6 +120,12 @@ def duplicate_object(context, ob):
 
 # Reminder: Valid values for `wrap_method` are 'NEAREST_SURFACEPOINT' | 'NEAREST_VERTEX' | 'PROJECT'.
 def add_shrinkwrap_shape_key(ob, name, target, wrap_method = 'NEAREST_SURFACEPOINT'):
+    # Wrap onto the full mesh, not the target's level of detail proxy
+    lod = target.modifiers.get('Species LOD')
+    if lod:
+        lod_show_viewport = lod.show_viewport
+        lod.show_viewport = False
+        bpy.context.scene.update()
     bpy.ops.object.select_all(action='DESELECT')
     bpy.context.scene.objects.active = ob
     bpy.ops.object.modifier_add(type='SHRINKWRAP')
@@ -72,6 +134,50 @@ def add_shrinkwrap_shape_key(ob, name, target, wrap_method = 'NEAREST_SURFACEPOI
     mod.target = target
     mod.wrap_method = wrap_method
     bpy.ops.object.modifier_apply(apply_as='SHAPE', modifier=name)
+    if lod:
+        lod.show_viewport = lod_show_viewport
+
+
+def get_mutation_scales(ob, genes, default):
+    """Per-gene mutation scales of an object, as left by self-adaptive mutation."""
+    scales = ob.get("species_mutation_scales", {})
+    return numpy.array([scales.get(gene, default) for gene in genes])
+
+def set_mutation_scales(ob, genes, scales):
+    ob["species_mutation_scales"] = {gene: float(s) for gene, s in zip(genes, scales)}
+
+
+def set_level_of_detail(ob, hidden, draw_type, decimate_ratio):
+    """Sets how an object is drawn in the viewport, the Decimate proxy being
+    only used on meshes. Rendering is never affected.
+    
+    Changes are recorded on the object, so that passing False, None, None
+    only reverts what this function did: objects hidden or given another
+    draw type by the user are left alone."""
+    if hidden and not ob.hide:
+        ob.hide = True
+        ob["species_lod_hidden"] = True
+    elif not hidden and "species_lod_hidden" in ob:
+        ob.hide = False
+        del ob["species_lod_hidden"]
+    
+    if draw_type:
+        if "species_draw_type" not in ob:
+            ob["species_draw_type"] = ob.draw_type
+        ob.draw_type = draw_type
+    elif "species_draw_type" in ob:
+        ob.draw_type = ob["species_draw_type"]
+        del ob["species_draw_type"]
+    
+    mod = ob.modifiers.get('Species LOD')
+    if decimate_ratio is None or ob.type != 'MESH':
+        if mod:
+            ob.modifiers.remove(mod)
+        return
+    if not mod:
+        mod = ob.modifiers.new('Species LOD', 'DECIMATE')
+        mod.show_render = False
+    mod.ratio = decimate_ratio
 
 
 def redraw_all_areas():
@@ -92,6 +198,13 @@ def override_generation_index_for_selected_objects(self, context):
         ob.specie.generation_index = self.generation_index_override
     call_tidy_up(self, context)
 
+def clear_mutation_scales_when_disabled(self, context):
+    if self.mutation_self_adaptive:
+        return
+    for ob in context.scene.objects:
+        if "species_mutation_scales" in ob:
+            del ob["species_mutation_scales"]
+
 
 #
 # Properties
@@ -103,24 +216,81 @@ class SpeciesScene(PropertyGroup):
     num_children_per_couple_without_shrinkwrap = IntProperty(name="Children per couple", default=0, min=0)
     num_children_per_couple_using_shrinkwrap = IntProperty(name="Children per couple", default=0, min=0)
     
+    crossover_method = EnumProperty(name="Crossover", items=[
+        ('LERP', "Lerp", "Each gene is a random linear interpolation between the parents' genes"),
+        ('UNIFORM', "Uniform", "Each gene is copied from either parent with equal probability"),
+        ('BLEND', "Blend-α", "Each gene is drawn uniformly from the parents' interval, extended on both sides by Alpha times its width"),
+        ('SBX', "SBX", "Simulated Binary Crossover, children spread around the parents according to Eta"),
+    ], default='LERP')
+    crossover_blend_alpha = FloatProperty(name="Alpha", description="Extension of the parents' interval for Blend-α crossover", default=0.5, min=0)
+    crossover_sbx_eta = FloatProperty(name="Eta", description="Distribution index for SBX crossover. Higher values keep children closer to their parents", default=2, min=0)
+    
     mutation_probability = FloatProperty(name="Mutation Probability", default=0.2, min=0, max=1)
-    mutation_normal_distribution_scale = FloatProperty(name="Scale of Normal Distribution for Mutations", default=0.4, min=0)
+    mutation_distribution = EnumProperty(name="Distribution", items=[
+        ('NORMAL', "Normal", "Gaussian mutations"),
+        ('CAUCHY', "Cauchy", "Heavy-tailed mutations, occasionally making large jumps"),
+    ], default='NORMAL')
+    mutation_normal_distribution_scale = FloatProperty(name="Mutation Scale", description="Scale of mutation steps, and initial per-gene scale for self-adaptive mutation", default=0.4, min=0)
+    mutation_self_adaptive = BoolProperty(name="Self-Adaptive", description="Each individual carries its own per-gene mutation scale, which is inherited and mutated along with its genes (the scale above is only used for individuals that don't have one yet). Turning this off discards all per-individual scales", default=False, update=clear_mutation_scales_when_disabled)
+    lod_enabled = BoolProperty(name="Level of Detail", description="Simplify the display of generations far from the focus generation", default=False, update=call_tidy_up)
+    lod_focus_generation = IntProperty(name="Focus Generation", description="Generation drawn at full detail (-1 for the newest one)", default=-1, min=-1, update=call_tidy_up)
+    lod_full_detail_range = IntProperty(name="Full Detail Range", description="Generations at most this far from the focus are drawn at full detail", default=1, min=0, update=call_tidy_up)
+    lod_visible_range = IntProperty(name="Visible Range", description="Generations further than this from the focus are hidden (0 shows all generations)", default=0, min=0, update=call_tidy_up)
+    lod_far_display = EnumProperty(name="Far Display", items=[
+        ('BOUNDS', "Bounds", "Draw far generations as bounding boxes"),
+        ('WIRE', "Wire", "Draw far generations as wireframes"),
+        ('DECIMATE', "Decimate", "Draw far generations through a decimated proxy of their mesh"),
+    ], default='BOUNDS', update=call_tidy_up)
+    lod_decimate_ratio = FloatProperty(name="Decimate Ratio", default=0.1, min=0, max=1, update=call_tidy_up)
+    dedup_distance = FloatProperty(name="Minimum Distance", description="Offspring closer than this to an existing individual or an earlier child (in shape key values, color and shrinkwrap weight) are resampled or dropped. Zero disables the check", default=0, min=0)
+    dedup_max_resamples = IntProperty(name="Resample Attempts", description="How many times a near-duplicate child is resampled before being dropped", default=3, min=0)
     generation_index_override = IntProperty(name="Generation Index Override", default=0, min=-1, update=override_generation_index_for_selected_objects)
     
-    def mix_scalar_genome(self, a, b, minn, maxn):
-        mixed = lerp(a, b, random.random())
-        if random.random() <= self.mutation_probability:
-            mixed += random.normal(scale = self.mutation_normal_distribution_scale)
-            mixed = numpy.clip(mixed, minn, maxn)
-        return mixed
+    def crossover(self, a, b, count):
+        """Returns `count` children of genome arrays `a` and `b`, as a (count, genes) array."""
+        shape = (count, len(a))
+        if self.crossover_method == 'UNIFORM':
+            return numpy.where(random.random(shape) < 0.5, a, b)
+        if self.crossover_method == 'BLEND':
+            lo, hi = numpy.minimum(a, b), numpy.maximum(a, b)
+            d = self.crossover_blend_alpha * (hi - lo)
+            return random.uniform(lo - d, hi + d, shape)
+        if self.crossover_method == 'SBX':
+            u = random.random(shape)
+            e = 1 / (self.crossover_sbx_eta + 1)
+            beta = numpy.where(u <= 0.5, (2*u)**e, (1 / (2*(1 - u)))**e)
+            sign = numpy.where(random.random(shape) < 0.5, -1, 1)
+            return 0.5 * ((a + b) + sign * beta * (b - a))
+        return lerp(a, b, random.random(shape))
+    
+    def mutate(self, population, scales, minn, maxn):
+        """Mutates a (count, genes) population in place, given per-gene mutation scales of the same shape."""
+        shape = population.shape
+        if self.mutation_distribution == 'CAUCHY':
+            steps = random.standard_cauchy(shape)
+        else:
+            steps = random.normal(size=shape)
+        mask = random.random(shape) <= self.mutation_probability
+        population += mask * scales * steps
+        numpy.clip(population, minn, maxn, out=population)
+        return population
     
-    def mix_vector_genome(self, a, b, minn, maxn):
-        mixed = Vector.lerp(a, b, random.random())
-        if random.random() <= self.mutation_probability:
-            m = lambda: random.normal(scale = self.mutation_normal_distribution_scale)
-            mixed += Vector((m(), m(), m()))
-            mixed = Vector(numpy.clip(mixed, minn, maxn))
-        return mixed
+    def mix_genomes(self, a, b, scales_a, scales_b, minn, maxn, count):
+        """Generates `count` children of genome arrays `a` and `b`.
+        Returns the (count, genes) population and its per-gene mutation scales."""
+        n = len(a)
+        if self.mutation_self_adaptive:
+            # ES-style log-normal self-adaptation, from the parents' geometric mean
+            tau_global = 1 / math.sqrt(2 * n)
+            tau_local = 1 / math.sqrt(2 * math.sqrt(n))
+            scales = numpy.sqrt(scales_a * scales_b) * numpy.exp(
+                tau_global * random.normal(size=(count, 1)) + tau_local * random.normal(size=(count, n))
+            )
+            scales = numpy.maximum(scales, 1e-6)
+        else:
+            scales = numpy.full((count, n), self.mutation_normal_distribution_scale)
+        population = self.crossover(a, b, count)
+        return self.mutate(population, scales, minn, maxn), scales
 
 
 class SpecieObject(PropertyGroup):
@@ -176,6 +346,17 @@ class TidyUpSpecies(Operator):
                 ob.location.x = g.grid_spacing[0] * ((i  % w) - (w-1)/2)
                 ob.location.y = g.grid_spacing[1] * ((i // w) - (h-1)/2)
                 ob.location.z = (gen_i - lowest_generation_index) * g.grid_spacing[2]
+        
+        # Level of detail, based on each generation's distance to the focus
+        focus = g.lod_focus_generation if g.lod_focus_generation >= 0 else max(generations)
+        for gen_i, obs in generations.items():
+            distance = abs(gen_i - focus)
+            hidden = g.lod_enabled and g.lod_visible_range > 0 and distance > g.lod_visible_range
+            far = g.lod_enabled and distance > g.lod_full_detail_range
+            draw_type = g.lod_far_display if far and g.lod_far_display != 'DECIMATE' else None
+            decimate_ratio = g.lod_decimate_ratio if far and g.lod_far_display == 'DECIMATE' else None
+            for ob in obs:
+                set_level_of_detail(ob, hidden, draw_type, decimate_ratio)
         return {'FINISHED'}
 
 
@@ -240,41 +421,100 @@ class MixSpecies(Operator):
             if ob.specie.generation_index < 0:
                 ob.specie.generation_index = highest_generation_index
 
+        # Candidates are checked for near-duplicates before any object is
+        # created, against every existing species object and every child
+        # accepted so far that shares their gene layout.
+        species_obs = []
+        if g.dedup_distance > 0:
+            species_obs = [
+                ob for ob in context.scene.objects
+                if ob.specie.generation_index >= 0 and ob.type == 'MESH' and ob.data.shape_keys
+                and ob.material_slots and ob.material_slots[0].material
+            ]
+        indices = {}
+        def get_index(keys, dad=None):
+            layout = (tuple(keys), dad.name if dad else None)
+            if layout not in indices:
+                index = indices[layout] = GenomeIndex(g.dedup_distance)
+                for ob in species_obs:
+                    kb = ob.data.shape_keys.key_blocks
+                    if not all(key in kb for key in keys):
+                        continue
+                    genome = [kb[key].value for key in keys] + list(ob.material_slots[0].material.diffuse_color)
+                    if dad:
+                        # Shrinkwrapped genomes also hold the blend weight towards dad
+                        modname = 'Shrinkwrap to ' + dad.name
+                        genome.append(1 if ob == dad else kb[modname].value if modname in kb else 0)
+                    index.insert(numpy.array(genome))
+            return indices[layout]
+        
         # Generate offspring
+        # Genomes are laid out as [shape keys..., r, g, b], plus the
+        # shrinkwrap weight for children using Shrinkwrap.
+        num_kept = 0
+        num_dropped = 0
         couples = [(obs[i], obs[(i+1)%len(obs)]) for i in range(len(obs))]
         for mom, dad in couples:
             mk = mom.data.shape_keys.key_blocks
             dk = dad.data.shape_keys.key_blocks
-            keys = set(mk.keys()).intersection(dk.keys())
+            keys = sorted(set(mk.keys()).intersection(dk.keys()))
+            genes = keys + ['color.r', 'color.g', 'color.b']
             next_gen = 1 + max(mom.specie.generation_index, dad.specie.generation_index)
-    
+            
+            a = numpy.array([mk[key].value for key in keys] + list(mom.material_slots[0].material.diffuse_color))
+            b = numpy.array([dk[key].value for key in keys] + list(dad.material_slots[0].material.diffuse_color))
+            minn = numpy.array([mk[key].slider_min for key in keys] + [0, 0, 0])
+            maxn = numpy.array([mk[key].slider_max for key in keys] + [1, 1, 1])
+            scales_a = get_mutation_scales(mom, genes, g.mutation_normal_distribution_scale)
+            scales_b = get_mutation_scales(dad, genes, g.mutation_normal_distribution_scale)
+            mix = lambda count: g.mix_genomes(a, b, scales_a, scales_b, minn, maxn, count)
+            
+            children, scales = mix(total_num_children)
             for i in range(total_num_children):
+                use_shrinkwrap = i < g.num_children_per_couple_using_shrinkwrap
+                index = get_index(keys, dad if use_shrinkwrap else None)
+                
+                for attempt in range(1 + g.dedup_max_resamples):
+                    if attempt > 0:
+                        children[i:i+1], scales[i:i+1] = mix(1)
+                    shrinkwrap_weight = random.random() if use_shrinkwrap else 0
+                    genome = numpy.append(children[i], shrinkwrap_weight) if use_shrinkwrap else children[i].copy()
+                    if not index.has_neighbour(genome):
+                        break
+                else:
+                    num_dropped += 1
+                    continue
+                index.insert(genome, offspring=True)
+                num_kept += 1
                 
                 ob = duplicate_object(context, mom)
                 ob.specie.generation_index = next_gen
+                set_level_of_detail(ob, False, None, None)
+                if g.mutation_self_adaptive:
+                    set_mutation_scales(ob, genes, scales[i])
+                elif "species_mutation_scales" in ob:
+                    del ob["species_mutation_scales"]
                 
                 # Use Shrinkwrap to blend between two models
-                if i < g.num_children_per_couple_using_shrinkwrap:
+                if use_shrinkwrap:
                     modname = 'Shrinkwrap to ' + dad.name
                     ob.location = dad.location.copy()
                     add_shrinkwrap_shape_key(ob, name=modname, target=dad)
-                    ob.data.shape_keys.key_blocks[modname].value = random.random()
+                    ob.data.shape_keys.key_blocks[modname].value = shrinkwrap_weight
                 
                 # Mix materials (only diffuse color)
-                for m in range(1):
-                    mmat = mom.material_slots[m].material
-                    dmat = dad.material_slots[m].material
-                    color = g.mix_vector_genome(
-                        Vector(mmat.diffuse_color), 
-                        Vector(dmat.diffuse_color),
-                        Vector((0,0,0)), Vector((1,1,1))
-                    )
-                    ob.material_slots[m].material.diffuse_color = Color(color)
+                ob.material_slots[0].material.diffuse_color = Color(children[i][-3:])
                 
                 # Mix shape keys
-                for key in keys:
-                    k = ob.data.shape_keys.key_blocks[key]
-                    k.value = g.mix_scalar_genome(mk[key].value, dk[key].value, k.slider_min, k.slider_max)
+                for key, value in zip(keys, children[i]):
+                    ob.data.shape_keys.key_blocks[key].value = value
+        
+        # Diversity metrics, among the new offspring only
+        nearest_distances = [d for index in indices.values() for d in index.offspring_nearest_distances()]
+        msg = "Mix: %d children kept, %d near-duplicates dropped" % (num_kept, num_dropped)
+        if nearest_distances:
+            msg += ", nearest-sibling distance: mean %.3f, min %.3f" % (numpy.mean(nearest_distances), numpy.min(nearest_distances))
+        self.report({'INFO'}, msg)
         
         bpy.ops.object.species_tidy_up('INVOKE_DEFAULT')
         return {'FINISHED'}
@@ -301,15 +541,41 @@ class MainPanel(Panel):
         c = self.layout.column(align=True)
         c.prop(context.scene.species, "grid_spacing", text="Grid Spacing")
         
+        c = self.layout.column(align=True)
+        c.label("Viewport:")
+        c.prop(context.scene.species, "lod_enabled")
+        if context.scene.species.lod_enabled:
+            c.prop(context.scene.species, "lod_focus_generation")
+            c.prop(context.scene.species, "lod_full_detail_range")
+            c.prop(context.scene.species, "lod_visible_range")
+            c.prop(context.scene.species, "lod_far_display", text="")
+            if context.scene.species.lod_far_display == 'DECIMATE':
+                c.prop(context.scene.species, "lod_decimate_ratio")
+        
         c = self.layout.column(align=True)
         c.label("Children per couple:")
         c.prop(context.scene.species, "num_children_per_couple_without_shrinkwrap", text="Without Shrinkwrap")
         c.prop(context.scene.species, "num_children_per_couple_using_shrinkwrap", text="Using Shrinkwrap")
         
+        c = self.layout.column(align=True)
+        c.label("Crossover:")
+        c.prop(context.scene.species, "crossover_method", text="")
+        if context.scene.species.crossover_method == 'BLEND':
+            c.prop(context.scene.species, "crossover_blend_alpha")
+        elif context.scene.species.crossover_method == 'SBX':
+            c.prop(context.scene.species, "crossover_sbx_eta")
+        
         c = self.layout.column(align=True)
         c.label("Mutations:")
         c.prop(context.scene.species, "mutation_probability")
+        c.prop(context.scene.species, "mutation_distribution", text="")
         c.prop(context.scene.species, "mutation_normal_distribution_scale")
+        c.prop(context.scene.species, "mutation_self_adaptive")
+        
+        c = self.layout.column(align=True)
+        c.label("Near-duplicates:")
+        c.prop(context.scene.species, "dedup_distance")
+        c.prop(context.scene.species, "dedup_max_resamples")
         
         c = self.layout.column(align=True)
         c.label("All objects:")